@@ -1,29 +1,99 @@
-import csv
+import collections
+import functools
+import io
 import json
+import operator
 import os
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from ipaddress import ip_address
 from pathlib import Path
 from sys import stderr, stdout
 
 import click
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 if __name__ == '__main__':
     from ipdata import IPData
 else:
     from .ipdata import IPData
 
 
+BATCH_WORKERS = IPData.pool_size
+BULK_CHUNK_SIZE = 100
+# bulk lookups are not part of the API key's plan, look up IPs one by one instead
+BULK_UNAVAILABLE_STATUSES = (403,)
+OUTPUT_BUFFER_SIZE = 1 << 20
+CSV_ROWS_PER_WRITE = 1000
+CSV_LINE_TERMINATOR = '\r\n'
+CSV_SPECIAL_CHARS = (',', '"', '\r', '\n')
+
+parse_ip = functools.lru_cache(maxsize=4096)(ip_address)
+
+
+def dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj).decode('utf-8')
+    # compact separators and unescaped non-ASCII, so the output is the same with or without orjson
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False)
+
+
+def dumpb(obj):
+    # UTF-8 encoded JSON, for writing straight to a binary stream
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return dumps(obj).encode('utf-8')
+
+
+def csv_escape(value, quote_empty=False):
+    # same quoting as csv.writer with the default (excel) dialect; csv.writer also quotes the empty value
+    # of a single-column row, which would otherwise be an empty line that readers skip
+    if value is None or value == '':
+        return '""' if quote_empty else ''
+    value = str(value)
+    if any(c in value for c in CSV_SPECIAL_CHARS):
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+
+def bounded_map(executor, fn, items, window):
+    # like executor.map, but only keeps `window` tasks in flight so finished results
+    # don't pile up in memory behind a slow one
+    pending = collections.deque()
+    try:
+        for item in items:
+            if len(pending) >= window:
+                yield pending.popleft().result()
+            pending.append(executor.submit(fn, item))
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # a task failed or the caller stopped early, don't run the queued ones
+        for future in pending:
+            future.cancel()
+
+
 class WrongAPIKey(Exception):
     pass
 
 
+class BulkLookupFailed(Exception):
+    def __init__(self, status, message):
+        super().__init__(f'Bulk lookup failed (Error: {status}): {message}')
+        self.status = status
+
+
 class IPAddressType(click.ParamType):
     name = 'IP_Address'
 
     def convert(self, value, param, ctx):
         try:
-            return ip_address(value)
+            return parse_ip(value)
         except:
             self.fail(f'{value} is not valid IPv4 or IPv6 address')
 
@@ -37,8 +107,9 @@ class IPAddressType(click.ParamType):
 def cli(ctx, api_key):
     ctx.ensure_object(dict)
     ctx.obj['api-key'] = get_and_check_api_key(api_key)
+    ctx.obj['ipdata'] = IPData(ctx.obj['api-key'])
     if ctx.invoked_subcommand is None:
-        print_ip_info(api_key)
+        print_ip_info(ctx.obj['ipdata'])
     else:
         pass
 
@@ -48,15 +119,14 @@ def get_api_key_path():
     return os.path.join(home, '.ipdata')
 
 
+@functools.lru_cache(maxsize=1)
 def get_api_key():
-    key_path = get_api_key_path()
-    if os.path.exists(key_path):
-        with open(key_path, 'r') as f:
-            for line in f:
-                if line:
-                    return line
-    else:
-        return None
+    key_path = Path(get_api_key_path())
+    if key_path.exists():
+        for line in key_path.read_text(encoding='utf-8').splitlines():
+            if line.strip():
+                return line.strip()
+    return None
 
 
 def get_and_check_api_key(api_key: str = None) -> str:
@@ -90,33 +160,56 @@ def init(api_key):
               file=stderr)
 
 
-def json_filter(json, fields):
+@functools.lru_cache(maxsize=None)
+def split_field(name):
+    return tuple(name.split('.'))
+
+
+def compile_fields(fields):
+    # ['a', 'b.c.d'] -> [('a',), ('b', 'c', 'd')], parsed once and reused for every result
+    return [split_field(name) for name in fields]
+
+
+def apply_filter(compiled_fields, json):
     res = dict()
-    for name in fields:
-        if name in json:
-            res[name] = json[name]
-        elif name.find('.') != -1:
-            parts = name.split('.')
-            part = parts[0] if len(parts) > 1 else None
-            if part and part in json:
-                sub_value = json_filter(json[part], ('.'.join(parts[1:]), ))
-                if isinstance(sub_value, dict):
-                    if part not in res:
-                        res[part] = sub_value
-                    else:
-                        res[part] = {**res[part], **sub_value}
-                else:
-                    res[part] = sub_value
+    for path in compiled_fields:
+        src, dst = json, res
+        for key in path[:-1]:
+            if not isinstance(src, dict) or key not in src:
+                break
+            src = src[key]
+            dst = dst.setdefault(key, {})
         else:
-            pass
+            if isinstance(src, dict) and path[-1] in src:
+                dst[path[-1]] = src[path[-1]]
     return res
 
 
+def server_fields(fields):
+    # top-level fields to ask the API for, or None if some of them can't be requested by name
+    names = list(dict.fromkeys(split_field(name)[0] for name in fields))
+    if all(name in IPData.valid_fields for name in names):
+        return names
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def make_filter(fields):
+    if not any('.' in name for name in fields):
+        # flat fields only (the common case): no path walking needed
+        return lambda json: {name: json[name] for name in fields if name in json}
+    return functools.partial(apply_filter, compile_fields(fields))
+
+
+def json_filter(json, fields):
+    return make_filter(tuple(fields))(json)
+
+
 @cli.command()
 @click.option('--fields', required=False, type=str, default=None, help='Coma separated list of fields to extract')
 @click.pass_context
 def me(ctx, fields):
-    print_ip_info(ctx.obj['api-key'], ip=None, fields=fields.split(',') if fields else None)
+    print_ip_info(ctx.obj['ipdata'], ip=None, fields=fields.split(',') if fields else None)
 
 
 @cli.command()
@@ -126,8 +219,10 @@ def me(ctx, fields):
 @click.option('--output-format', required=False, type=click.Choice(('JSON', 'CSV'), case_sensitive=False), default='JSON',
               help='Format of output')
 @click.option('--fields', required=False, type=str, default=None, help='Coma separated list of fields to extract')
+@click.option('--concurrency', required=False, type=click.IntRange(min=1), default=BATCH_WORKERS,
+              help='Number of lookup requests to run in parallel')
 @click.pass_context
-def batch(ctx, ip_list, output, output_format, fields):
+def batch(ctx, ip_list, output, output_format, fields, concurrency):
     extract_fields = fields.split(',') if fields else None
 
     if output_format == 'CSV' and extract_fields is None:
@@ -135,34 +230,112 @@ def batch(ctx, ip_list, output, output_format, fields):
               f'because of plain nature of CSV format. Please use JSON format instead.', file=stderr)
         return
 
+    if output.name != stdout.name:
+        # large write buffer keeps the number of syscalls down on big exports
+        output = io.TextIOWrapper(io.BufferedWriter(output.buffer.raw, buffer_size=OUTPUT_BUFFER_SIZE),
+                                  encoding='utf-8')
+        ctx.call_on_close(output.close)
+    else:
+        # results hold non-ASCII text (emoji flags, city names), write UTF-8 whatever the console encoding is
+        output.flush()
+        output = io.TextIOWrapper(output.buffer, encoding='utf-8')
+        ctx.call_on_close(output.detach)
+
     result_context = {}
     if output_format == 'CSV':
-        print(f'# {fields}', file=output)  # print comment with columns
-        result_context['writer'] = csv.writer(output)
+        # the columns are fixed for the whole run, so rows are formatted directly instead of via csv.writer
+        result_context['row_format'] = ','.join(['{}'] * len(extract_fields)) + CSV_LINE_TERMINATOR
+        if len(extract_fields) == 1:
+            # itemgetter with a single key returns the value itself rather than a tuple
+            field_getter = operator.itemgetter(extract_fields[0])
+            result_context['getter'] = lambda res: (field_getter(res),)
+            result_context['escape'] = functools.partial(csv_escape, quote_empty=True)
+        else:
+            result_context['getter'] = operator.itemgetter(*extract_fields)
+            result_context['escape'] = csv_escape
+        result_context['rows'] = [result_context['row_format'].format(*[csv_escape(k) for k in extract_fields])]
 
         def print_result(res):
-            result_context['writer'].writerow([res[k] for k in extract_fields])
+            rows = result_context['rows']
+            rows.append(result_context['row_format'].format(*map(result_context['escape'], result_context['getter'](res))))
+            if len(rows) >= CSV_ROWS_PER_WRITE:
+                output.write(''.join(rows))
+                rows.clear()
 
         def finish():
-            pass
+            output.write(''.join(result_context['rows']))
 
     elif output_format == 'JSON':
-        result_context['results'] = []
+        # stream {"results": [...]} record by record instead of buffering all results
+        result_context['first'] = True
+        output.write('{"results": [')
 
         def print_result(res):
-            result_context['results'].append(res)
+            if result_context['first']:
+                result_context['first'] = False
+            else:
+                output.write(',')
+            output.write(dumps(res))
 
         def finish():
-            json.dump(result_context, fp=output)
+            output.write(']}')
 
     else:
         print(f'Unsupported format: {output_format}', file=stderr)
         return
 
-    for ip in ip_list:
-        ip = ip.strip()
-        if len(ip) > 0:
-            print_result(get_ip_info(ctx.obj['api-key'], ip=ip.strip(), fields=extract_fields))
+    ip_data = ctx.obj['ipdata']
+    if concurrency > IPData.pool_size:
+        ip_data = IPData(ctx.obj['api-key'], pool_size=concurrency)
+    result_filter = make_filter(tuple(extract_fields)) if extract_fields else None
+    request_fields = server_fields(extract_fields) if extract_fields else None
+
+    def filter_results(responses):
+        return [result_filter(r) for r in responses] if result_filter else responses
+
+    def lookup_ip(ip):
+        return filter_results([ip_data.lookup(ip, fields=request_fields)])
+
+    failed = threading.Event()
+
+    def lookup_chunk(chunk):
+        if failed.is_set():
+            # an earlier chunk failed, its results will be thrown away anyway
+            return []
+        if len(chunk) == 1:
+            # bulk lookups need at least 2 IP addresses
+            return lookup_ip(chunk[0])
+        res = ip_data.bulk_lookup(chunk, fields=request_fields)
+        if res['status'] != 200:
+            failed.set()
+            raise BulkLookupFailed(res['status'], res.get('message'))
+        # same shape as the records returned by lookup()
+        for r in res['responses']:
+            r['status'] = res['status']
+        return filter_results(res['responses'])
+
+    ips = [ip for ip in (line.strip() for line in ip_list) if ip]
+    chunks = [ips[i:i + BULK_CHUNK_SIZE] for i in range(0, len(ips), BULK_CHUNK_SIZE)]
+    try:
+        try:
+            # the first chunk tells whether bulk lookups are available for the API key at all
+            first = lookup_chunk(chunks[0]) if chunks else []
+            tasks, lookup = chunks[1:], lookup_chunk
+        except BulkLookupFailed as e:
+            if e.status not in BULK_UNAVAILABLE_STATUSES:
+                raise
+            first, tasks, lookup = [], ips, lookup_ip
+
+        for res in first:
+            print_result(res)
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for responses in bounded_map(executor, lookup, tasks, 2 * concurrency):
+                for res in responses:
+                    print_result(res)
+    except BulkLookupFailed as e:
+        # keep what was looked up so far, but don't let a partial result pass for a complete one
+        finish()
+        raise click.ClickException(str(e)) from e
     finish()
 
 
@@ -171,24 +344,29 @@ def batch(ctx, ip_list, output, output_format, fields):
 @click.option('--fields', required=False, type=str, default=None, help='Coma separated list of fields to extract')
 @click.option('--api-key', required=False, default=None, help='IPData API Key')
 def ip(ip, fields, api_key):
-    print_ip_info(get_and_check_api_key(api_key),
+    print_ip_info(IPData(get_and_check_api_key(api_key)),
                   ip=ip, fields=fields.split(',') if fields else None)
 
 
-def print_ip_info(api_key, ip=None, fields=None):
+def print_ip_info(ip_data, ip=None, fields=None):
     try:
-        json.dump(get_ip_info(api_key, ip, fields), stdout)
+        res = get_ip_info(ip_data, ip, fields)
+        # UTF-8 bytes, so non-ASCII values don't fail on consoles with another encoding
+        stdout.flush()
+        stdout.buffer.write(dumpb(res))
+        stdout.buffer.flush()
     except ValueError as e:
         print(f'Error: IP address {e}', file=stderr)
 
 
-def get_ip_info(api_key, ip=None, fields=None):
-    ip_data = IPData(get_and_check_api_key(api_key))
+def get_ip_info(ip_data, ip=None, fields=None):
+    request_fields = server_fields(fields) if fields else None
     if ip:
-        res = ip_data.lookup(ip)
+        res = ip_data.lookup(ip, fields=request_fields)
     else:
-        res = ip_data.lookup()
+        res = ip_data.lookup(fields=request_fields)
     if fields and len(fields) > 0:
+        # still needed for nested fields, and drops the 'status' key added by lookup()
         return json_filter(res, fields)
     else:
         return res
@@ -198,11 +376,16 @@ def lookup_field(data, field):
     if field in data:
         return field, data[field]
     elif '.' in field:
-        parent, children = field.split('.')
-        parent_field, parent_data = lookup_field(data, parent)
-        if parent_field:
-            children_field, children_data = lookup_field(parent_data, children)
-            return parent_field, {parent_field: children_data}
+        path = split_field(field)
+        if path[0] not in data:
+            return None, None
+        value = data[path[0]]
+        for key in path[1:]:
+            if not isinstance(value, dict) or key not in value:
+                value = None
+                break
+            value = value[key]
+        return path[0], {path[0]: value}
     return None, None
 
 
@@ -211,19 +394,23 @@ def lookup_field(data, field):
 # @click.argument('fields', type=str, nargs=-1)
 # @click.option('--api_key', required=False, default=None, help='IPData API Key')
 # def ip(ip, fields, api_key):
-#     print_ip_info(api_key, ip, fields)
+#     print_ip_info(IPData(api_key), ip, fields)
 
 
 @cli.command()
 @click.pass_context
 def info(ctx):
-    res = IPData(get_and_check_api_key(ctx.obj['api-key'])).lookup('8.8.8.8')
+    res = ctx.obj['ipdata'].lookup('8.8.8.8')
     print(f'Number of requests made: {res["count"]}')
 
 
 def is_ip_address(value):
+    # cheap check first so that command names and options never reach the parser; a parsed address is
+    # cached by parse_ip and reused when IPAddressType converts the same argument
+    if not value or not (value[0].isdigit() or ':' in value):
+        return False
     try:
-        ip_address(value)
+        parse_ip(value)
         return True
     except ValueError:
         return False
@@ -2,6 +2,7 @@
 
 import ipaddress
 import requests
+from requests.adapters import HTTPAdapter
 
 
 class APIKeyNotSet(Exception):
@@ -19,12 +20,17 @@ class IPData:
                     'continent_code', 'latitude', 'longitude', 'asn', 'organisation', 'postal', 'calling_code', 'flag',
                     'emoji_flag', 'emoji_unicode', 'carrier', 'languages', 'currency', 'time_zone', 'threat', 'count',
                     'status'}
+    pool_size = 32
 
-    def __init__(self, api_key):
+    def __init__(self, api_key, pool_size=None):
         if not api_key:
             raise APIKeyNotSet("Missing API Key")
+        if pool_size is None:
+            pool_size = self.pool_size
         self.api_key = api_key
         self.headers = {'user-agent': 'ipdata-pypi'}
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
 
     def _validate_fields(self, select_field=None, fields=None):
         if fields is None:
@@ -65,7 +71,7 @@ class IPData:
         if fields:
             self._validate_fields(fields=fields)
             query_params['fields'] = ','.join(fields)
-        response = requests.get(f"{self.base_url}{query}", headers=self.headers, params=query_params)
+        response = self.session.get(f"{self.base_url}{query}", headers=self.headers, params=query_params)
         status_code = response.status_code
         if select_field and status_code == 200:
             try:
@@ -92,7 +98,7 @@ class IPData:
         if fields:
             self._validate_fields(fields=fields)
             query_params['fields'] = ','.join(fields)
-        response = requests.post(f"{self.bulk_url}", headers=self.headers, params=query_params, json=ips)
+        response = self.session.post(f"{self.bulk_url}", headers=self.headers, params=query_params, json=ips)
         status_code = response.status_code
         if not status_code == 200:
             response = response.json()
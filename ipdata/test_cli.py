@@ -1,6 +1,18 @@
-from unittest import TestCase
+import csv
+import io
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase, mock
 
-from ipdata.cli import json_filter
+from click.testing import CliRunner
+
+from ipdata.cli import (apply_filter, bounded_map, compile_fields, csv_escape, dumps, get_api_key, is_ip_address, json_filter,
+                        lookup_field, make_filter, print_ip_info, server_fields)
+from ipdata.cli import cli
+from ipdata.ipdata import IPData
 
 
 class CliTestCase(TestCase):
@@ -18,3 +30,174 @@ class CliTestCase(TestCase):
 
         res = json_filter(json, ('d',))
         self.assertDictEqual({'d': 3}, res)
+
+    def test_compile_fields(self):
+        self.assertListEqual([('a',), ('b', 'c', 'd')], compile_fields(['a', 'b.c.d']))
+
+    def test_apply_filter(self):
+        json = {'a': {'b': {'c': 1, 'd': 2}, 'e': 3}, 'f': 4}
+
+        res = apply_filter(compile_fields(['a.b.c', 'a.e', 'f']), json)
+        self.assertDictEqual({'a': {'b': {'c': 1}, 'e': 3}, 'f': 4}, res)
+
+        res = apply_filter(compile_fields(['a.x', 'g']), json)
+        self.assertDictEqual({'a': {}}, res)
+
+    def test_csv_escape(self):
+        row = ['8.8.8.8', 'a, b', 'say "hi"', 'x\ny', None, 15169, True, {'a': 1}]
+        expected = io.StringIO()
+        csv.writer(expected).writerow(row)
+        self.assertEqual(expected.getvalue(), ','.join(csv_escape(v) for v in row) + '\r\n')
+
+        for value in ('', None):
+            expected = io.StringIO()
+            csv.writer(expected).writerow([value])
+            self.assertEqual(expected.getvalue(), csv_escape(value, quote_empty=True) + '\r\n')
+
+    def test_lookup_field(self):
+        data = {'a': {'b': {'c': 1}}, 'd': 2}
+        self.assertTupleEqual(('d', 2), lookup_field(data, 'd'))
+        self.assertTupleEqual(('a', {'a': {'c': 1}}), lookup_field(data, 'a.b'))
+        self.assertTupleEqual(('a', {'a': 1}), lookup_field(data, 'a.b.c'))
+        self.assertTupleEqual(('a', {'a': None}), lookup_field(data, 'a.x'))
+        self.assertTupleEqual((None, None), lookup_field(data, 'x.y'))
+
+    def test_is_ip_address(self):
+        self.assertTrue(is_ip_address('8.8.8.8'))
+        self.assertTrue(is_ip_address('2001:4860:4860::8888'))
+        self.assertFalse(is_ip_address('batch'))
+        self.assertFalse(is_ip_address('--api-key'))
+        self.assertFalse(is_ip_address('8.8.8'))
+        self.assertFalse(is_ip_address(''))
+
+    def test_get_api_key(self):
+        with tempfile.TemporaryDirectory() as home:
+            key_path = os.path.join(home, '.ipdata')
+            with open(key_path, 'w') as f:
+                f.write('\n  test-key  \n')
+            with mock.patch('ipdata.cli.get_api_key_path', return_value=key_path):
+                get_api_key.cache_clear()
+                self.assertEqual('test-key', get_api_key())
+        get_api_key.cache_clear()
+
+    def test_make_filter(self):
+        json = {'a': {'b': 1, 'c': 2}, 'd': 3}
+        self.assertDictEqual({'d': 3}, make_filter(('d', 'x'))(json))
+        self.assertDictEqual({'a': {'c': 2}, 'd': 3}, make_filter(('a.c', 'd'))(json))
+        self.assertIs(make_filter(('a.c', 'd')), make_filter(('a.c', 'd')))
+
+    def test_server_fields(self):
+        self.assertListEqual(['ip', 'asn', 'threat'], server_fields(['ip', 'asn', 'threat.is_tor', 'threat.is_proxy']))
+        self.assertIsNone(server_fields(['ip', 'unknown']))
+
+    def test_dumps_without_orjson(self):
+        obj = {'ip': '8.8.8.8', 'city': 'São Paulo', 'emoji_flag': '🇧🇷', 'threat': {'is_tor': False},
+               'languages': [{'name': 'Portuguese', 'native': 'Português'}]}
+        expected = dumps(obj)
+        with mock.patch('ipdata.cli.orjson', None):
+            self.assertEqual(expected, dumps(obj))
+
+    def test_bounded_map(self):
+        pulled = []
+
+        def items():
+            for i in range(50):
+                pulled.append(i)
+                yield i
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = bounded_map(executor, lambda x: x * 2, items(), 4)
+            self.assertEqual(0, next(results))
+            # four tasks in flight plus the item waiting for a free slot
+            self.assertEqual(5, len(pulled))
+            self.assertListEqual([x * 2 for x in range(1, 50)], list(results))
+
+    def test_print_ip_info_non_utf8_stdout(self):
+        ip_data = mock.Mock()
+        ip_data.lookup.return_value = {'ip': '8.8.8.8', 'emoji_flag': '🇺🇸', 'status': 200}
+        out = io.TextIOWrapper(io.BytesIO(), encoding='cp1252')
+        with mock.patch('ipdata.cli.stdout', out):
+            print_ip_info(ip_data, ip='8.8.8.8', fields=['emoji_flag'])
+        self.assertEqual('{"emoji_flag":"🇺🇸"}', out.buffer.getvalue().decode('utf-8'))
+
+
+def fake_lookup(self, ip=None, select_field=None, fields=None):
+    return {'ip': ip, 'country_code': 'US', 'status': 200}
+
+
+def fake_bulk_lookup(self, ips=None, fields=None):
+    return {'responses': [{'ip': ip, 'country_code': 'US'} for ip in ips], 'status': 200}
+
+
+class BatchTestCase(TestCase):
+    def run_batch(self, ips, *args):
+        with tempfile.TemporaryDirectory() as tmp:
+            ip_list, output = os.path.join(tmp, 'ips.txt'), os.path.join(tmp, 'out.txt')
+            with open(ip_list, 'w') as f:
+                f.write('\n'.join(ips))
+            result = CliRunner().invoke(cli, ['--api-key', 'test', 'batch', ip_list, '--output', output, *args],
+                                        obj={})
+            with open(output) as f:
+                return result, f.read()
+
+    def test_batch_bulk(self):
+        ips = [f'1.1.{i // 256}.{i % 256}' for i in range(201)]
+        with mock.patch.object(IPData, 'lookup', autospec=True, side_effect=fake_lookup) as lookup, \
+                mock.patch.object(IPData, 'bulk_lookup', autospec=True, side_effect=fake_bulk_lookup) as bulk_lookup:
+            result, output = self.run_batch(ips)
+        self.assertEqual(0, result.exit_code)
+        self.assertEqual(2, bulk_lookup.call_count)
+        self.assertEqual(1, lookup.call_count)
+        self.assertListEqual([{'ip': ip, 'country_code': 'US', 'status': 200} for ip in ips],
+                             json.loads(output)['results'])
+
+    def test_batch_output_written_on_error(self):
+        ips = [f'1.1.{i // 256}.{i % 256}' for i in range(150)]
+        with mock.patch.object(IPData, 'bulk_lookup', autospec=True,
+                               side_effect=[fake_bulk_lookup(None, ips[:100]), ValueError('is a private IP Address')]):
+            result, output = self.run_batch(ips, '--fields', 'ip')
+        self.assertIsInstance(result.exception, ValueError)
+        # records written before the failure reach the file
+        self.assertTrue(output.startswith('{"results": [{"ip":"1.1.0.0"}'))
+        self.assertIn('{"ip":"1.1.0.99"}', output)
+
+    def test_batch_bulk_not_available(self):
+        ips = [f'1.1.{i // 256}.{i % 256}' for i in range(150)]
+        forbidden = {'message': 'Bulk lookups are not available on your plan', 'status': 403}
+        with mock.patch.object(IPData, 'lookup', autospec=True, side_effect=fake_lookup) as lookup, \
+                mock.patch.object(IPData, 'bulk_lookup', autospec=True, return_value=forbidden) as bulk_lookup:
+            result, output = self.run_batch(ips, '--output-format', 'CSV', '--fields', 'ip')
+        self.assertEqual(0, result.exit_code)
+        self.assertEqual(1, bulk_lookup.call_count)
+        self.assertEqual(150, lookup.call_count)
+        self.assertListEqual(['ip', *ips], output.splitlines())
+
+    def test_batch_bulk_error(self):
+        ips = [f'1.1.{i // 256}.{i % 256}' for i in range(150)]
+        unauthorized = {'message': 'You have not provided a valid API Key', 'status': 401}
+        with mock.patch.object(IPData, 'lookup', autospec=True, side_effect=fake_lookup) as lookup, \
+                mock.patch.object(IPData, 'bulk_lookup', autospec=True, return_value=unauthorized):
+            result, output = self.run_batch(ips)
+        self.assertEqual(1, result.exit_code)
+        self.assertEqual(0, lookup.call_count)
+        self.assertIn('(Error: 401)', result.output)
+        self.assertDictEqual({'results': []}, json.loads(output))
+
+    def test_batch_bulk_error_mid_run(self):
+        ips = [f'1.1.{i // 256}.{i % 256}' for i in range(2000)]
+        throttled = {'message': 'Too many requests', 'status': 429}
+
+        def bulk_lookup(self, ips=None, fields=None):
+            if ips[0] == '1.1.0.100':
+                time.sleep(0.01)
+                return throttled
+            time.sleep(0.1)
+            return fake_bulk_lookup(self, ips)
+
+        with mock.patch.object(IPData, 'bulk_lookup', autospec=True, side_effect=bulk_lookup) as bulk:
+            result, output = self.run_batch(ips, '--concurrency', '2')
+        self.assertEqual(1, result.exit_code)
+        self.assertIn('(Error: 429)', result.output)
+        # the first chunk, the failed one and the one running next to it; queued chunks are never sent
+        self.assertEqual(3, bulk.call_count)
+        self.assertListEqual(ips[:100], [r['ip'] for r in json.loads(output)['results']])
@@ -26,6 +26,7 @@ setup(
     packages=["ipdata"],
     include_package_data=True,
     install_requires=["requests", "ipaddress", "click"],
+    extras_require={"fast": ["orjson"]},
     entry_points={
         'console_scripts': [
             'ipdata = ipdata.cli:todo',